@@ -1,13 +1,69 @@
 import argparse
+import contextlib
+import hashlib
+import json
+import math
 import os
+import random
+import re
+import sqlite3
+import threading
 import time
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlparse
 
+import requests
 import settings
 from slack import WebClient
-from trello import Board, Card, TrelloClient
+from trello import Board, TrelloClient
+from urllib3.exceptions import NewConnectionError
+
+CARD_ACTIONS = {
+    "createCard": "created",
+    "updateCard": "updated",
+    "commentCard": "commented",
+}
+# Actions which change board metadata, always fetched to keep it up to date
+METADATA_ACTIONS = {"updateBoard", "createList", "updateList"}
+# Actions which change the members of a card, always fetched to keep cached card
+# members up to date
+MEMBER_ACTIONS = {"addMemberToCard", "removeMemberFromCard"}
+# Card fields needed to fill in message placeholders
+PLACEHOLDER_FIELDS = {
+    "%card_title%": "name",
+    "%card_url%": "shortUrl",
+}
+# Slack errors which reject a single recipient for good, its messages are skipped
+SLACK_RECIPIENT_ERRORS = {
+    "channel_not_found",
+    "user_not_found",
+    "is_archived",
+    "not_in_channel",
+    "cannot_dm_bot",
+    "user_disabled",
+}
+# Action fields used for notifications, everything else is left out of responses
+ACTION_FIELDS = "id,type,date,data"
+# Maximum number of URLs Trello accepts per /batch request
+TRELLO_BATCH_SIZE = 10
+# Maximum number of actions Trello returns per page
+TRELLO_PAGE_LIMIT = 1000
+# Seconds for which responses of slow-changing Trello resources are reused
+# before they are revalidated with ETag/Last-Modified, by request path
+TRELLO_CACHE_POLICIES = [
+    (re.compile(r"^/1/members/me/organizations$"), 3600),
+    (re.compile(r"^/1/organizations/[^/]+/members$"), 3600),
+    (re.compile(r"^/1/members/me/boards$"), 0),
+    (re.compile(r"^/1/boards/[^/]+$"), 0),
+]
 
 
 def line(c="-"):
@@ -15,6 +71,264 @@ def line(c="-"):
     print(c * int(cols))
 
 
+def parse_date(value):
+    """Parses a Trello date string into a naive UTC datetime"""
+    return datetime.fromisoformat(value.rstrip("Z"))
+
+
+def plan_fetches(hook_boards, deadline):
+    """Merges the boards of all hooks into one fetch per board, using the union
+    of all triggers and the oldest cursor of the hooks watching it"""
+    plan = {}
+    for hook, boards in hook_boards.items():
+        for board in boards:
+            cursor = hook.get_cursor(board.id)
+            entry = plan.setdefault(
+                board.id,
+                {
+                    "board": board,
+                    "triggers": METADATA_ACTIONS | MEMBER_ACTIONS,
+                    "cursor": cursor,
+                    "deadline": deadline,
+                },
+            )
+            entry["triggers"].update(hook.triggers)
+            if cursor.date < entry["cursor"].date:
+                entry["cursor"] = cursor
+    return plan
+
+
+def probe_boards(member_boards, plan, checked_activity):
+    """Splits the plan into the boards whose last activity is newer than their
+    cursor and the activity they were last fully processed up to, and the ones
+    which can be skipped"""
+    active, idle = {}, []
+    for board_id, entry in plan.items():
+        # Boards the member doesn't belong to can't be probed
+        last_activity = member_boards.get(board_id, {}).get("dateLastActivity")
+        if last_activity:
+            entry["last_activity"] = parse_date(last_activity)
+            checked = max(
+                entry["cursor"].date, checked_activity.get(board_id, datetime.min)
+            )
+            if entry["last_activity"] <= checked:
+                idle.append(board_id)
+                continue
+        active[board_id] = entry
+    return active, idle
+
+
+def plan_organization_feeds(member_boards, plan, min_boards):
+    """Moves the boards of every organization with at least min_boards planned
+    boards out of the plan into a single feed of organization actions"""
+    organizations = {}
+    for board_id in plan:
+        org_id = member_boards.get(board_id, {}).get("idOrganization")
+        if org_id:
+            organizations.setdefault(org_id, []).append(board_id)
+    return {
+        org_id: {board_id: plan.pop(board_id) for board_id in board_ids}
+        for org_id, board_ids in organizations.items()
+        if len(board_ids) >= min_boards
+    }
+
+
+def submit_fetches(pool, trello_api, plan, feeds):
+    """Submits the planned board action fetches and organization feeds and
+    returns a future per board id, grouping board fetches into /batch requests
+    if batching is enabled"""
+    board_futures = {board_id: Future() for board_id in plan}
+    for org_id, entries in feeds.items():
+        board_futures.update({board_id: Future() for board_id in entries})
+        pool.submit(
+            org_id, fetch_organization, trello_api, org_id, entries, board_futures
+        )
+        # Organization feeds don't depend on the lists, which are only needed to
+        # match actions, so they're loaded alongside
+        for board_id, entry in entries.items():
+            pool.submit(board_id, trello_api.boards.refresh, [entry["board"]])
+    if getattr(settings, "TRELLO_BATCH_REQUESTS", False):
+        entries = list(plan.items())
+        for i in range(0, len(entries), TRELLO_BATCH_SIZE):
+            pool.submit(
+                f"batch-{i}",
+                fetch_batch,
+                pool,
+                trello_api,
+                entries[i : i + TRELLO_BATCH_SIZE],
+                board_futures,
+            )
+    else:
+        for board_id, entry in plan.items():
+            pool.submit(
+                board_id, fetch_board, trello_api, entry, board_futures[board_id]
+            )
+    return board_futures
+
+
+def fetch_board(trello_api, entry, future, first_page=None):
+    """Loads the board if needed and pages through its actions, resolving its
+    future with the ActionPages as soon as the first page has arrived"""
+    pages = ActionPages()
+    try:
+        trello_api.boards.refresh([entry["board"]])
+        if entry["board"].closed:
+            raise BoardArchived(f"Board {entry['board'].id} is archived")
+        for page in trello_api.iter_action_pages(
+            f"/boards/{entry['board'].id}/actions",
+            sorted(entry["triggers"]),
+            entry["cursor"].since(),
+            entry["deadline"],
+            first_page,
+        ):
+            trello_api.boards.apply_actions(page)
+            pages.add(page)
+            if not future.done():
+                future.set_result(pages)
+        pages.finish()
+    except Exception as e:
+        pages.finish(e)
+        if not future.done():
+            future.set_exception(e)
+
+
+def fetch_batch(pool, trello_api, entries, board_futures):
+    """Fetches the first action page of up to TRELLO_BATCH_SIZE boards with one
+    request, then resolves the future of every board or keeps paging it"""
+    try:
+        trello_api.boards.refresh([entry["board"] for _, entry in entries])
+        for board_id, entry in entries:
+            if entry["board"].closed:
+                board_futures[board_id].set_exception(
+                    BoardArchived(f"Board {board_id} is archived")
+                )
+        entries = [x for x in entries if not x[1]["board"].closed]
+        results = trello_api.fetch_actions_batch(
+            [
+                (
+                    f"/boards/{board_id}/actions",
+                    sorted(entry["triggers"]),
+                    entry["cursor"].since(),
+                )
+                for board_id, entry in entries
+            ]
+        )
+    except Exception as e:
+        entries = [x for x in entries if not board_futures[x[0]].done()]
+        results = [e] * len(entries)
+    for (board_id, entry), result in zip(entries, results):
+        if isinstance(result, Exception):
+            board_futures[board_id].set_exception(result)
+        elif len(result) < TRELLO_PAGE_LIMIT:
+            fetch_board(trello_api, entry, board_futures[board_id], result)
+        else:
+            pool.submit(
+                board_id,
+                fetch_board,
+                trello_api,
+                entry,
+                board_futures[board_id],
+                result,
+            )
+
+
+def fetch_organization(trello_api, org_id, entries, board_futures):
+    """Pages through the actions of an organization and routes them to the
+    ActionPages of the planned boards they belong to"""
+    board_pages = {board_id: ActionPages() for board_id in entries}
+    triggers = set().union(*[x["triggers"] for x in entries.values()])
+    cursor = min((x["cursor"] for x in entries.values()), key=lambda x: x.date)
+    deadline = min(x["deadline"] for x in entries.values())
+    try:
+        for page in trello_api.iter_action_pages(
+            f"/organizations/{org_id}/actions",
+            sorted(triggers),
+            cursor.since(),
+            deadline,
+        ):
+            trello_api.boards.apply_actions(page)
+            routed = {board_id: [] for board_id in board_pages}
+            for action in page:
+                board_id = action["data"].get("board", {}).get("id")
+                if board_id in routed:
+                    routed[board_id].append(action)
+            for board_id, actions in routed.items():
+                board_pages[board_id].add(actions)
+                if not board_futures[board_id].done():
+                    board_futures[board_id].set_result(board_pages[board_id])
+        for pages in board_pages.values():
+            pages.finish()
+    except Exception as e:
+        for board_id, pages in board_pages.items():
+            pages.finish(e)
+            if not board_futures[board_id].done():
+                board_futures[board_id].set_exception(e)
+
+
+def get_required_fields(slack_message):
+    """Returns the card fields needed to send a Slack message"""
+    fields = {
+        field
+        for placeholder, field in PLACEHOLDER_FIELDS.items()
+        if placeholder in slack_message["message"]
+    }
+    if slack_message["recipient"] == "CARD_ASSIGNMENT":
+        fields.add("idMembers")
+    return fields
+
+
+def parse_retry_after(value):
+    """Returns the seconds of a Retry-After header, 0 if it is missing"""
+    try:
+        return max(0, float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def trello_retry_after(response, error):
+    """Returns the delay before retrying a failed Trello request, or None if it
+    shouldn't be retried"""
+    if error is not None:
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return 0
+        return None
+    if response.status_code == 429 or response.status_code >= 500:
+        return parse_retry_after(response.headers.get("Retry-After"))
+    return None
+
+
+def slack_retry_after(response, error):
+    """Returns the delay before retrying a failed Slack call, or None if it
+    shouldn't be retried"""
+    if isinstance(error, SlackError):
+        status = error.response.status_code
+        if status == 429 or status >= 500:
+            return parse_retry_after(error.response.headers.get("Retry-After"))
+        return None
+    # A message may already have been posted if the connection failed later on
+    if isinstance(error, requests.ConnectTimeout) or (
+        isinstance(error, requests.ConnectionError)
+        and isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+    ):
+        return 0
+    return None
+
+
+def get_error_status(error):
+    """Returns the HTTP status of a failed Trello request, if known"""
+    status = getattr(error, "_status", None) or getattr(error, "status", None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_client_error(error):
+    """Returns whether a Trello request failed with a permanent 4xx status"""
+    status = get_error_status(error)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
 def get_user_mapping(trello_id=None, slack_id=None):
     if trello_id is None and slack_id is None:
         raise Exception("Neither slack id nor trello id provided")
@@ -29,10 +343,970 @@ def get_user_mapping(trello_id=None, slack_id=None):
     )
 
 
-class TrelloApi:
+class Metrics:
+    """Thread-safe counters and gauges, logged every METRICS_LOG_SECONDS"""
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def maximum(self, name, value):
+        with self.lock:
+            self.values[name] = max(self.values.get(name, value), value)
+
+    def get(self, name, default=0):
+        with self.lock:
+            return self.values.get(name, default)
+
+    def log(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        print(
+            "Metrics: "
+            + ", ".join(
+                f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}"
+                for k, v in values
+            )
+        )
+
+
+METRICS = Metrics()
+
+
+class SlackError(Exception):
+    """A Slack Web API call failed"""
+
+    def __init__(self, response, error):
+        super().__init__(f"Slack API failed with {response.status_code}: {error}")
+        self.response = response
+        self.error = error
+
+
+class BoardArchived(Exception):
+    """A watched board has been archived"""
+
+
+class FetchDeadlineExceeded(TimeoutError):
+    """The actions of a board couldn't be fetched within BOARD_DEADLINE_SECONDS"""
+
+
+class TrelloBatchError(Exception):
+    """A single URL of a /batch request failed"""
+
+    def __init__(self, url, status, body):
+        super().__init__(f"{url} failed with {status}: {body}")
+        self.url = url
+        self.status = status
+
+
+class ActionPages:
+    """The actions of a board, consumable by several hooks while the remaining
+    pages are still being fetched"""
+
+    def __init__(self):
+        self.pages = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def count(self):
+        """Returns the number of actions fetched so far"""
+        with self.condition:
+            return sum(len(x) for x in self.pages)
+
+    def add(self, page):
+        with self.condition:
+            self.pages.append(page)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def __iter__(self):
+        index = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.pages) > index or self.done)
+                if len(self.pages) > index:
+                    page = self.pages[index]
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            index += 1
+            yield from page
+
+
+class Cursor:
+    """Position of the newest processed action of a board, taken from Trello's
+    response so it doesn't depend on the local clock"""
+
+    def __init__(self, action_id=None, date=None):
+        self.action_id = action_id
+        self.date = date or datetime.utcnow()
+
+    @classmethod
+    def from_action(cls, action):
+        return cls(action["id"], parse_date(action["date"]))
+
+    def since(self):
+        """Returns the value for the since parameter of action queries"""
+        if self.action_id is not None:
+            return self.action_id
+        return f"{self.date.replace(microsecond=0).isoformat()}Z"
+
+    def is_before(self, action):
+        """Whether the action is newer than this cursor"""
+        if self.action_id is not None:
+            return action["id"] > self.action_id
+        return parse_date(action["date"]) > self.date
+
+
+class CursorStore:
+    """Persists the cursors of all hooks in SQLite so restarts neither replay
+    nor drop actions"""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cursors (hook TEXT, board TEXT, "
+            "action_id TEXT, date TEXT, PRIMARY KEY (hook, board))"
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def load(self, hook_key, catch_up):
+        """Returns the stored cursors of a hook, moving cursors older than the
+        catch-up window to its start"""
+        oldest = datetime.utcnow() - catch_up
+        cursors = {}
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT board, action_id, date FROM cursors WHERE hook = ?",
+                (hook_key,),
+            ).fetchall()
+        for board_id, action_id, date in rows:
+            date = parse_date(date)
+            if date < oldest:
+                cursors[board_id] = Cursor(date=oldest)
+            else:
+                cursors[board_id] = Cursor(action_id, date)
+        return cursors
+
+    def stage(self, hook_key, board_id, cursor):
+        """Remembers a cursor until the next commit, None deletes it"""
+        with self.lock:
+            self.pending[(hook_key, board_id)] = cursor
+
+    def commit(self):
+        """Writes all staged cursors in a single transaction"""
+        with self.lock:
+            if not self.pending:
+                return
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?)",
+                    [
+                        (hook_key, board_id, x.action_id, x.date.isoformat())
+                        for (hook_key, board_id), x in self.pending.items()
+                        if x is not None
+                    ],
+                )
+                self.connection.executemany(
+                    "DELETE FROM cursors WHERE hook = ? AND board = ?",
+                    [key for key, x in self.pending.items() if x is None],
+                )
+            self.pending.clear()
+
+
+class PollScheduler:
+    """Polls boards with recent activity every POLL_MIN_SECONDS and backs off
+    exponentially on idle boards up to POLL_MAX_SECONDS"""
+
+    def __init__(self):
+        self.base_interval = settings.CHECK_INTERVAL_SECONDS
+        self.min_interval = getattr(settings, "POLL_MIN_SECONDS", self.base_interval)
+        self.max_interval = getattr(settings, "POLL_MAX_SECONDS", self.base_interval)
+        self.intervals = {}
+        self.next_polls = {}
+
+    def is_due(self, board_id, now):
+        return self.next_polls.get(board_id, now) <= now
+
+    def forget(self, board_id):
+        """Drops the schedule of a board which is no longer watched"""
+        self.intervals.pop(board_id, None)
+        self.next_polls.pop(board_id, None)
+
+    def record(self, board_id, action_count, now):
+        """Schedules the next poll of a board after it was polled, action_count
+        is None if the poll failed"""
+        interval = self.intervals.get(board_id, self.base_interval)
+        if action_count:
+            interval = self.min_interval
+        elif action_count == 0:
+            interval = min(interval * 2, self.max_interval)
+        self.intervals[board_id] = interval
+        self.next_polls[board_id] = now + interval
+
+    def sleep_time(self, now):
+        """Returns the time until the next board is due, waking up at least every
+        CHECK_INTERVAL_SECONDS to pick up new boards"""
+        return max(
+            0, min([self.base_interval] + [x - now for x in self.next_polls.values()])
+        )
+
+
+class CycleClock:
+    """Starts cycles on a fixed grid of ticks on the monotonic clock, so the
+    time spent in a cycle doesn't shift the following ones. Ticks missed by an
+    overrunning cycle are skipped instead of run back to back, and a random
+    delay of up to CYCLE_JITTER_SECONDS keeps replicas out of lockstep"""
+
+    def __init__(self, period, jitter):
+        self.period = period
+        self.jitter = jitter
+        self.origin = time.monotonic()
+        self.tick = self.origin
+
+    def wait(self, due):
+        """Sleeps until the first tick at or after due and returns that tick"""
+        now = time.monotonic()
+        due = max(due, self.tick + self.period)
+        # Rounded so float errors don't push a tick to the next one
+        ticks = math.ceil(round((due - self.origin) / self.period, 6))
+        tick = self.origin + ticks * self.period
+        # How far the loop is behind the tick it should have started at next
+        METRICS.set("cycle_lag_seconds", max(0.0, now - tick))
+        if tick < now:
+            skipped = math.ceil((now - tick) / self.period)
+            METRICS.increment("cycles_skipped", skipped)
+            tick += skipped * self.period
+        time.sleep(tick + random.uniform(0, self.jitter) - now)
+        self.tick = tick
+        return tick
+
+
+class BoardRegistry:
+    """Long-lived Board objects with their names, open lists and an index from
+    lowercase list names to list ids, reloaded within BOARD_CACHE_TTL_SECONDS
+    and patched by board and list actions"""
+
+    def __init__(self, trello_api, ttl):
+        self.trello_api = trello_api
+        self.ttl = ttl
+        self.boards = {}
+        self.expires = {}
+        # Date of the last action applied to a board name or list name
+        self.dates = {}
+        self.lock = threading.Lock()
+
+    def get(self, board_id, name=None):
+        """Returns the Board object of a board id"""
+        with self.lock:
+            board = self.boards.get(board_id)
+            if board is None:
+                board = Board(client=self.trello_api.client, board_id=board_id)
+                board.lists = {}
+                board.closed = False
+                # None until the lists of the board have been loaded
+                board.list_index = None
+                self.boards[board_id] = board
+            if name:
+                board.name = name
+            return board
+
+    def refresh(self, boards):
+        """Loads the name and lists of all boards which haven't been loaded yet or
+        expired"""
+        now = time.monotonic()
+        stale = {x.id: x for x in boards if self.expires.get(x.id, now) <= now}
+        with self.trello_api.transport.low_priority():
+            results = self.trello_api.fetch_many(
+                [f"/boards/{x}" for x in stale],
+                {"fields": "name,closed", "lists": "open", "list_fields": "name"},
+            )
+        for board, result in zip(stale.values(), results):
+            if isinstance(result, Exception):
+                print(f"WARNING: Could not load board {board.id}: {result}")
+                continue
+            with self.lock:
+                board.name = result["name"]
+                board.closed = result.get("closed", False)
+                board.lists = {x["id"]: x["name"] for x in result["lists"]}
+                self.index_lists(board)
+                # Archived boards are reloaded once they are polled again, the
+                # others expire at different times so they aren't all reloaded
+                # in the same cycle
+                if not board.closed:
+                    self.expires[board.id] = now + self.ttl * random.uniform(0.5, 1)
+
+    def index_lists(self, board):
+        list_index = {}
+        for list_id, name in board.lists.items():
+            list_index.setdefault(name.lower(), set()).add(list_id)
+        board.list_index = list_index
+
+    def apply_actions(self, actions):
+        """Updates board and list names from updateBoard, createList and
+        updateList actions newer than the last change"""
+        for action in actions:
+            if action["type"] not in METADATA_ACTIONS:
+                continue
+            data = action["data"]
+            date = parse_date(action["date"])
+            with self.lock:
+                board = self.boards.get(data["board"]["id"])
+                if board is None:
+                    continue
+                key = (board.id, data["list"]["id"] if "list" in data else None)
+                if self.dates.get(key, date) > date:
+                    continue
+                self.dates[key] = date
+                if action["type"] == "updateBoard":
+                    board.name = data["board"].get("name", board.name)
+                elif data["list"].get("closed"):
+                    board.lists.pop(data["list"]["id"], None)
+                elif "name" in data["list"]:
+                    board.lists[data["list"]["id"]] = data["list"]["name"]
+                if board.list_index is not None:
+                    self.index_lists(board)
+
+
+class BoardHealth:
+    """Circuit breaker per board which opens after CIRCUIT_BREAKER_FAILURES
+    failed polls in a row and lets a single poll through after exponentially
+    growing pauses. Deleted, forbidden and archived boards are remembered as
+    unavailable for UNAVAILABLE_BOARD_SECONDS"""
+
+    def __init__(self):
+        self.threshold = getattr(settings, "CIRCUIT_BREAKER_FAILURES", 3)
+        self.base_delay = getattr(settings, "CIRCUIT_BREAKER_SECONDS", 60)
+        self.max_delay = getattr(settings, "CIRCUIT_BREAKER_MAX_SECONDS", 3600)
+        self.unavailable_delay = getattr(settings, "UNAVAILABLE_BOARD_SECONDS", 3600)
+        self.failures = {}
+        self.open_until = {}
+        self.unavailable = set()
+
+    def allows(self, board_id, now):
+        """Whether a board may be polled"""
+        return self.open_until.get(board_id, now) <= now
+
+    def record_success(self, board_id):
+        self.failures.pop(board_id, None)
+        self.open_until.pop(board_id, None)
+        self.unavailable.discard(board_id)
+        self.update_metrics()
+
+    def record_failure(self, board_id, error, now):
+        failures = self.failures.get(board_id, 0) + 1
+        self.failures[board_id] = failures
+        METRICS.increment("board_poll_failures")
+        if get_error_status(error) in (401, 404):
+            self.mark_unavailable(board_id, now)
+        elif failures >= self.threshold:
+            self.open_until[board_id] = now + min(
+                self.max_delay, self.base_delay * 2 ** (failures - self.threshold)
+            )
+            self.update_metrics()
+
+    def prune(self, now):
+        """Drops the pauses which have run out, so their boards count as half
+        open until their next poll succeeds or fails"""
+        for board_id, until in list(self.open_until.items()):
+            if until <= now:
+                del self.open_until[board_id]
+                self.unavailable.discard(board_id)
+        self.update_metrics()
+
+    def forget(self, board_id):
+        """Drops the state of a board which is no longer watched"""
+        self.failures.pop(board_id, None)
+        self.open_until.pop(board_id, None)
+        self.unavailable.discard(board_id)
+        self.update_metrics()
+
+    def mark_unavailable(self, board_id, now):
+        self.unavailable.add(board_id)
+        self.open_until[board_id] = now + self.unavailable_delay
+        self.update_metrics()
+
+    def update_metrics(self):
+        METRICS.set("boards_unavailable", len(self.unavailable))
+        METRICS.set("boards_circuit_open", len(self.open_until) - len(self.unavailable))
+
+
+class StarredBoards:
+    """The starred boards, reloaded every STARRED_REFRESH_SECONDS"""
+
+    def __init__(self, trello_api, interval):
+        self.trello_api = trello_api
+        self.interval = interval
+        self.boards = []
+        self.expires = 0
+
+    def get(self, now):
+        """Returns the starred boards and the ids of boards which were unstarred
+        since the last call"""
+        if now < self.expires:
+            return self.boards, set()
+        boards = self.trello_api.get_starred_boards()
+        old_ids = {x.id for x in self.boards}
+        new_ids = {x.id for x in boards}
+        for board in boards:
+            if board.id not in old_ids and self.expires:
+                print(f"Watching newly starred board {board.name}")
+        for board in self.boards:
+            if board.id not in new_ids:
+                print(f"No longer watching unstarred board {board.name}")
+        self.boards = boards
+        self.expires = now + self.interval
+        return boards, old_ids - new_ids
+
+
+class SingleFlight:
+    """Lets concurrent callers of an identical request share a single call and
+    its result"""
+
     def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class WorkPool:
+    """Fixed number of worker threads shared by all fetches and hooks, taking
+    turns between the queues of different keys so a hook or board with a lot
+    of work can't hold back the others"""
+
+    def __init__(self, workers):
+        self.queues = OrderedDict()
+        self.condition = threading.Condition()
+        self.queued = 0
+        for i in range(workers):
+            threading.Thread(target=self.work, name=f"worker-{i}", daemon=True).start()
+
+    def submit(self, key, func, *args, **kwargs):
+        future = Future()
+        self.enqueue(key, future, func, args, kwargs)
+        return future
+
+    def submit_after(self, parent, key, func, *args):
+        """Queues func with the result of the parent future once it's done,
+        without occupying a worker in the meantime"""
+        future = Future()
+
+        def done(parent):
+            if parent.exception() is not None:
+                future.set_exception(parent.exception())
+            else:
+                self.enqueue(key, future, func, args + (parent.result(),), {})
+
+        parent.add_done_callback(done)
+        return future
+
+    def enqueue(self, key, future, func, args, kwargs):
+        with self.condition:
+            self.queues.setdefault(key, deque()).append((future, func, args, kwargs))
+            self.queued += 1
+            METRICS.maximum("work_queued_max", self.queued)
+            self.condition.notify()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.queues:
+                    self.condition.wait()
+                # Serve the first queue and move it to the end
+                key, queue = self.queues.popitem(last=False)
+                future, func, args, kwargs = queue.popleft()
+                if queue:
+                    self.queues[key] = queue
+                self.queued -= 1
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class CardCache:
+    """LRU cache of fetched card fields, patched in place by updateCard and
+    member actions so a card is only fetched again once it changed or expired"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cards = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, card_id, fields):
+        """Returns the cached card if it has all requested fields"""
+        with self.lock:
+            entry = self.cards.get(card_id)
+            if entry is None:
+                return None
+            if entry["expires"] < time.monotonic():
+                del self.cards[card_id]
+                return None
+            if not fields <= entry["fields"].keys():
+                return None
+            self.cards.move_to_end(card_id)
+            return dict(entry["fields"])
+
+    def put(self, card_id, fields):
+        """Adds the fetched fields of a card, as of the current time"""
+        now = datetime.utcnow()
+        with self.lock:
+            entry = self.cards.pop(card_id, None)
+            if entry is None or entry["expires"] < time.monotonic():
+                entry = {"fields": {}, "dates": {}}
+            entry["fields"].update(fields)
+            entry["dates"].update({x: now for x in fields})
+            entry["expires"] = time.monotonic() + self.ttl
+            self.cards[card_id] = entry
+            while len(self.cards) > self.max_size:
+                self.cards.popitem(last=False)
+
+    def apply_action(self, action):
+        """Patches the fields of a cached card changed by an updateCard action if
+        they are older than the action, fields whose new value is unknown are
+        dropped"""
+        if action["type"] not in MEMBER_ACTIONS | {"updateCard"}:
+            return
+        card = action["data"]["card"]
+        date = parse_date(action["date"])
+        # Member actions only name the added or removed member
+        fields = ["idMembers"]
+        if action["type"] == "updateCard":
+            fields = action["data"].get("old", {})
+        with self.lock:
+            entry = self.cards.get(card["id"])
+            if entry is None:
+                return
+            for field in fields:
+                if field not in entry["fields"] or entry["dates"][field] >= date:
+                    continue
+                if field in card:
+                    entry["fields"][field] = card[field]
+                    entry["dates"][field] = date
+                else:
+                    del entry["fields"][field]
+                    del entry["dates"][field]
+
+
+class CardEvent:
+    """A card notification built from the payload of a Trello action"""
+
+    def __init__(self, action, board):
+        card = action["data"]["card"]
+        self.card_id = card["id"]
+        # Card fields known from the action payload
+        self.fields = {}
+        if "name" in card:
+            self.fields["name"] = card["name"]
+        if "shortLink" in card:
+            self.fields["shortUrl"] = f"https://trello.com/c/{card['shortLink']}"
+        self.board_name = action["data"].get("board", {}).get("name", board.name)
+        self.card_action = CARD_ACTIONS[action["type"]]
+        self.action = action
+
+    @property
+    def name(self):
+        return self.fields.get("name", "")
+
+    @property
+    def short_url(self):
+        return self.fields.get("shortUrl", "")
+
+    @property
+    def member_ids(self):
+        return self.fields.get("idMembers", [])
+
+    def missing_fields(self, required_fields):
+        """Returns the required fields the action payload lacked"""
+        return required_fields - self.fields.keys()
+
+    def update(self, card):
+        """Fills in the missing fields from a fetched card"""
+        self.fields.update({k: v for k, v in card.items() if k != "id"})
+
+
+class RetryPolicy:
+    """Retries transient failures with jittered exponential backoff, honoring
+    Retry-After, within a budget of retries and seconds per call"""
+
+    def __init__(self, name, max_retries, budget, base_delay=1, max_delay=30):
+        self.name = name
+        self.max_retries = max_retries
+        self.budget = budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def call(self, retry_after, func, *args, **kwargs):
+        """Calls func until it succeeds or the budget is used up. retry_after
+        gets the result and error of every attempt and returns None if it is
+        final, otherwise the delay requested by the server or 0"""
+        deadline = time.monotonic() + self.budget
+        attempt = 0
+        while True:
+            result = error = None
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                error = e
+            delay = retry_after(result, error)
+            if delay is not None and attempt < self.max_retries:
+                delay = delay or random.uniform(
+                    0, min(self.max_delay, self.base_delay * 2**attempt)
+                )
+                if time.monotonic() + delay <= deadline:
+                    METRICS.increment(f"{self.name}_retries")
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+            if error is not None:
+                raise error
+            return result
+
+
+def get_retry_policy(name):
+    return RetryPolicy(
+        name,
+        getattr(settings, "MAX_RETRIES", 3),
+        getattr(settings, "RETRY_BUDGET_SECONDS", 30),
+    )
+
+
+class TokenBucket:
+    """Request budget shared by all Trello requests, refilled at Trello's rate
+    limit and calibrated from the x-rate-limit-* response headers. Low priority
+    requests leave a reserve of tokens to high priority ones"""
+
+    def __init__(self, capacity, interval, reserve):
+        self.capacity = capacity
+        self.rate = capacity / interval
+        self.reserve = reserve
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, low_priority=False):
+        """Blocks until a token is available and takes it"""
+        floor = self.capacity * self.reserve if low_priority else 0
+        with self.condition:
+            self.refill()
+            if self.tokens < floor + 1:
+                METRICS.increment("trello_rate_limit_waits")
+            while self.tokens < floor + 1:
+                self.condition.wait((floor + 1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+    def calibrate(self, headers):
+        """Adopts the most restrictive of the token and key limits reported by
+        Trello and its remaining requests"""
+        limits = []
+        for scope in ("token", "key"):
+            prefix = f"x-rate-limit-api-{scope}"
+            try:
+                limits.append(
+                    (
+                        int(headers[f"{prefix}-max"]),
+                        int(headers[f"{prefix}-interval-ms"]) / 1000,
+                        int(headers[f"{prefix}-remaining"]),
+                    )
+                )
+            except (KeyError, ValueError):
+                continue
+        if not limits:
+            return
+        with self.condition:
+            self.refill()
+            self.capacity, interval, _ = min(limits, key=lambda x: x[0] / x[1])
+            self.rate = self.capacity / interval
+            self.tokens = min(self.tokens, min(x[2] for x in limits))
+
+
+class HttpPool:
+    """Keep-alive session whose connection pool for one host is sized to the
+    worker concurrency, recording how long requests wait for a connection"""
+
+    def __init__(self, name, base_url, size):
+        self.name = name
+        self.base_url = base_url
+        self.size = size
+        self.session = requests.Session()
+        self.session.mount(
+            base_url,
+            requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=size, pool_block=True
+            ),
+        )
+        self.slots = threading.BoundedSemaphore(size)
+
+    def request(self, method, url, **kwargs):
+        start = time.monotonic()
+        with self.slots:
+            waited = time.monotonic() - start
+            METRICS.increment(f"{self.name}_pool_wait_seconds", waited)
+            METRICS.maximum(f"{self.name}_pool_wait_max", waited)
+            return self.session.request(method, url, **kwargs)
+
+    def warm(self, timeout=5):
+        """Opens all connections of the pool ahead of the first cycle"""
+
+        def connect():
+            try:
+                self.request("HEAD", self.base_url, timeout=timeout)
+            except requests.RequestException:
+                pass
+
+        with ThreadPoolExecutor(self.size) as executor:
+            for _ in range(self.size):
+                executor.submit(connect)
+
+
+class TrelloTransport:
+    """HTTP service for py-trello which answers requests for slow-changing
+    resources from a cache, revalidated with ETag/Last-Modified once their
+    policy's TTL has passed. Requests have connect and read timeouts, and GET
+    requests slower than the 95th percentile can be hedged with a second one"""
+
+    def __init__(self, policies, pool_size):
+        self.policies = policies
+        self.cache = {}
+        self.lock = threading.Lock()
+        # Trello allows 100 requests per 10 seconds and token by default
+        self.bucket = TokenBucket(
+            100, 10, getattr(settings, "TRELLO_RATE_LIMIT_RESERVE", 0.2)
+        )
+        self.local = threading.local()
+        self.retry_policy = get_retry_policy("trello")
+        self.timeout = (
+            getattr(settings, "TRELLO_CONNECT_TIMEOUT_SECONDS", 5),
+            getattr(settings, "TRELLO_READ_TIMEOUT_SECONDS", 30),
+        )
+        self.latencies = deque(maxlen=200)
+        self.hedge_executor = None
+        if getattr(settings, "TRELLO_HEDGE_REQUESTS", False):
+            # Every slot holds a request and its hedge, so neither waits for a
+            # thread, requests beyond the slots aren't hedged
+            self.hedge_slots = threading.Semaphore(pool_size)
+            self.hedge_executor = ThreadPoolExecutor(
+                2 * pool_size, thread_name_prefix="hedge"
+            )
+            pool_size *= 2
+        self.pool = HttpPool("trello", "https://api.trello.com/", pool_size)
+
+    @contextlib.contextmanager
+    def low_priority(self):
+        """Marks the requests of the current thread as low priority"""
+        self.local.low_priority = True
+        try:
+            yield
+        finally:
+            self.local.low_priority = False
+
+    def send(self, method, url, **kwargs):
+        """Sends a request once the rate limit allows it, retrying rate limited
+        requests, server errors and connection errors"""
+        return self.retry_policy.call(
+            trello_retry_after, self.send_once, method, url, **kwargs
+        )
+
+    def send_once(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        low_priority = getattr(self.local, "low_priority", False)
+        # Hedging needs enough samples for a meaningful percentile
+        if (
+            method != "GET"
+            or self.hedge_executor is None
+            or len(self.latencies) < 20
+            or not self.hedge_slots.acquire(blocking=False)
+        ):
+            return self.timed_request(low_priority, method, url, **kwargs)
+        futures = [
+            self.hedge_executor.submit(
+                self.timed_request, low_priority, method, url, **kwargs
+            )
+        ]
+        try:
+            done, _ = wait(futures, timeout=self.get_latency_percentile(0.95))
+            if not done:
+                METRICS.increment("trello_hedged_requests")
+                futures.append(
+                    self.hedge_executor.submit(
+                        self.timed_request, low_priority, method, url, **kwargs
+                    )
+                )
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        finally:
+            self.release_hedge_slot(futures)
+        winner = next(iter(done))
+        if winner.exception() is not None and len(futures) > 1:
+            return futures[futures[0] is winner].result()
+        return winner.result()
+
+    def release_hedge_slot(self, futures):
+        """Frees the hedge slot once the slower request has finished as well"""
+        pending = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                pending[0] -= 1
+                if pending[0] == 0:
+                    self.hedge_slots.release()
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def timed_request(self, low_priority, method, url, **kwargs):
+        self.bucket.acquire(low_priority)
+        start = time.monotonic()
+        response = self.pool.request(method, url, **kwargs)
+        with self.lock:
+            self.latencies.append(time.monotonic() - start)
+        METRICS.set("trello_latency_p95", self.get_latency_percentile(0.95))
+        METRICS.set("trello_latency_p99", self.get_latency_percentile(0.99))
+        self.bucket.calibrate(response.headers)
+        return response
+
+    def get_latency_percentile(self, percentile):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile))]
+
+    def get_ttl(self, method, url):
+        """Returns the TTL of a cacheable request or None"""
+        if method != "GET":
+            return None
+        path = urlparse(url).path
+        for pattern, ttl in self.policies:
+            if pattern.match(path):
+                return ttl
+        return None
+
+    def replay(self, entry):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = entry["url"]
+        response.encoding = entry["encoding"]
+        response.headers.update(entry["headers"])
+        response._content = entry["content"]
+        return response
+
+    def count(self, name):
+        METRICS.increment(name)
+        hits = METRICS.get("trello_cache_hits") + METRICS.get(
+            "trello_cache_revalidated"
+        )
+        total = hits + METRICS.get("trello_cache_misses")
+        METRICS.set("trello_cache_hit_rate", hits / total)
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        ttl = self.get_ttl(method, url)
+        if ttl is None:
+            return self.send(method, url, params=params, headers=headers, **kwargs)
+        key = (url, tuple(sorted((params or {}).items())))
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is not None and entry["expires"] > time.monotonic():
+            self.count("trello_cache_hits")
+            return self.replay(entry)
+        headers = dict(headers or {})
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        response = self.send(method, url, params=params, headers=headers, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.count("trello_cache_revalidated")
+            entry["expires"] = time.monotonic() + ttl
+            return self.replay(entry)
+        self.count("trello_cache_misses")
+        if response.status_code == 200:
+            with self.lock:
+                self.cache[key] = {
+                    "url": response.url,
+                    "encoding": response.encoding,
+                    "headers": dict(response.headers),
+                    "content": response.content,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "expires": time.monotonic() + ttl,
+                }
+        return response
+
+
+class TrelloApi:
+    def __init__(self, pool_size=10):
+        self.transport = TrelloTransport(TRELLO_CACHE_POLICIES, pool_size)
         self.client = TrelloClient(
-            api_key=settings.TRELLO_API_KEY, api_secret=settings.TRELLO_API_SECRET
+            api_key=settings.TRELLO_API_KEY,
+            api_secret=settings.TRELLO_API_SECRET,
+            http_service=self.transport,
+        )
+        self.requests_in_flight = SingleFlight()
+        self.boards = BoardRegistry(
+            self, getattr(settings, "BOARD_CACHE_TTL_SECONDS", 3600)
+        )
+        self.card_cache = CardCache(
+            getattr(settings, "CARD_CACHE_SIZE", 1000),
+            getattr(settings, "CARD_CACHE_TTL_SECONDS", 300),
+        )
+        # Shared budget of concurrent action page requests across all boards
+        self.page_requests = threading.BoundedSemaphore(
+            getattr(settings, "TRELLO_MAX_CONCURRENT_PAGES", 8)
+        )
+
+    def fetch_json(self, path, query_params=None):
+        """Sends a GET request to Trello, sharing the response with concurrent
+        identical requests"""
+        query_params = query_params or {}
+        key = (path, tuple(sorted(query_params.items())))
+        return self.requests_in_flight.do(
+            key, self.client.fetch_json, path, query_params=dict(query_params)
         )
 
     def print_users(self):
@@ -41,42 +1315,184 @@ class TrelloApi:
         print("Trello users:")
         line()
         users = set()
-        organizations = self.client.list_organizations()
+        organizations = self.fetch_json(
+            "/members/me/organizations", query_params={"fields": "id"}
+        )
         for org in organizations:
-            users.update([f"{x.full_name}: {x.id}" for x in org.get_members()])
+            members = self.fetch_json(
+                f"/organizations/{org['id']}/members",
+                query_params={"fields": "fullName"},
+            )
+            users.update([f"{x['fullName']}: {x['id']}" for x in members])
         for user in users:
             print(user)
 
     def get_starred_boards(self):
         """Returns all starred boards"""
-        return self.client.list_boards(board_filter="starred")
-
-    def fetch_cards(self, triggers, board, target_list, since):
-        result = set()
-        cards = board.fetch_actions(triggers, since=since)
-        for card_data in cards:
-            list_name = (
-                card_data["data"]["listAfter"]["name"]
+        boards = self.fetch_json(
+            "/members/me/boards", query_params={"filter": "starred", "fields": "name"}
+        )
+        return [self.boards.get(x["id"], x["name"]) for x in boards]
+
+    def get_member_boards(self):
+        """Returns the organization and last activity of every board of the
+        member by board id"""
+        boards = self.fetch_json(
+            "/members/me/boards",
+            query_params={"fields": "id,idOrganization,dateLastActivity"},
+        )
+        return {x["id"]: x for x in boards}
+
+    def action_query(self, triggers, since):
+        """Returns the query parameters for a page of actions, leaving out all
+        fields which aren't needed for notifications"""
+        return {
+            "filter": ",".join(triggers),
+            "fields": ACTION_FIELDS,
+            "member": "false",
+            "memberCreator": "false",
+            "limit": TRELLO_PAGE_LIMIT,
+            "since": since,
+        }
+
+    def iter_action_pages(self, path, triggers, since, deadline, first_page=None):
+        """Yields the pages of all actions of a board or organization matching
+        any of the triggers, newest first, until a page is no longer full or the
+        monotonic deadline has passed"""
+        page = first_page
+        query_params = self.action_query(triggers, since)
+        while True:
+            if page is None:
+                if time.monotonic() > deadline:
+                    raise FetchDeadlineExceeded(f"{path} took too long")
+                with self.page_requests:
+                    page = self.fetch_json(path, query_params=query_params)
+            yield page
+            if len(page) < TRELLO_PAGE_LIMIT:
+                return
+            query_params["before"] = page[-1]["id"]
+            page = None
+
+    def fetch_batch(self, urls):
+        """Fetches up to TRELLO_BATCH_SIZE GET URLs with a single /batch request,
+        returns the decoded response or a TrelloBatchError for every URL"""
+        responses = self.fetch_json("/batch", query_params={"urls": ",".join(urls)})
+        results = []
+        for url, response in zip(urls, responses):
+            if "200" in response:
+                results.append(response["200"])
+            else:
+                status = response.get("statusCode", next(iter(response), None))
+                results.append(TrelloBatchError(url, status, response))
+        return results
+
+    def fetch_batched(self, urls):
+        """Fetches any number of GET URLs in chunks of /batch requests"""
+        results = []
+        for i in range(0, len(urls), TRELLO_BATCH_SIZE):
+            results.extend(self.fetch_batch(urls[i : i + TRELLO_BATCH_SIZE]))
+        return results
+
+    def fetch_actions_batch(self, queries):
+        """Returns the actions for a list of (path, triggers, since) queries using
+        /batch requests, with a TrelloBatchError in place of failed queries"""
+        return self.fetch_batched(
+            [
+                f"{path}?{urlencode(self.action_query(triggers, since))}"
+                for path, triggers, since in queries
+            ]
+        )
+
+    def fetch_many(self, paths, query_params):
+        """Fetches several GET paths with the same query parameters, grouped into
+        /batch requests if batching is enabled, with the error in place of every
+        failed path"""
+        results = []
+        if getattr(settings, "TRELLO_BATCH_REQUESTS", False):
+            urls = [f"{x}?{urlencode(query_params)}" for x in paths]
+            for i in range(0, len(urls), TRELLO_BATCH_SIZE):
+                chunk = urls[i : i + TRELLO_BATCH_SIZE]
+                try:
+                    results.extend(self.fetch_batch(chunk))
+                except Exception as e:
+                    results.extend([e] * len(chunk))
+            return results
+        for path in paths:
+            try:
+                results.append(self.fetch_json(path, query_params=query_params))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def fetch_cards(
+        self, triggers, board, target_list, cursor, actions, required_fields=frozenset()
+    ):
+        """Returns card events for all matching actions after the cursor, only
+        fetching the required fields the action payload and card cache lack"""
+        list_ids = None
+        if target_list != "ANY" and board.list_index is not None:
+            list_ids = board.list_index.get(target_list.lower(), set())
+        result = []
+        for card_data in actions:
+            self.card_cache.apply_action(card_data)
+            if card_data["type"] not in triggers:
+                continue
+            if not cursor.is_before(card_data):
+                continue
+            action_list = (
+                card_data["data"]["listAfter"]
                 if "listAfter" in card_data["data"]
-                else card_data["data"]["list"]["name"]
+                else card_data["data"]["list"]
             )
-            if target_list != "ANY" and list_name.lower() != target_list.lower():
+            if list_ids is not None:
+                if action_list["id"] not in list_ids:
+                    continue
+            # Lists of boards which couldn't be loaded are matched by name
+            elif (
+                target_list != "ANY"
+                and action_list["name"].lower() != target_list.lower()
+            ):
+                continue
+            result.append(CardEvent(card_data, board))
+        missing = []
+        for event in result:
+            fields = event.missing_fields(required_fields)
+            if not fields:
                 continue
-            card = Card(board, card_data["data"]["card"]["id"])
-            card.fetch(eager=False)
-            if card_data["type"] == "createCard":
-                card.card_action = "created"
-            elif card_data["type"] == "updateCard":
-                card.card_action = "updated"
-            elif card_data["type"] == "commentCard":
-                card.card_action = "commented"
-            result.add(card)
+            card = self.card_cache.get(event.card_id, fields)
+            if card is not None:
+                event.update(card)
+            else:
+                missing.append(event)
+        if missing:
+            fields = set().union(*[x.missing_fields(required_fields) for x in missing])
+            with self.transport.low_priority():
+                cards = self.fetch_many(
+                    [f"/cards/{x.card_id}" for x in missing],
+                    {"fields": ",".join(sorted(fields))},
+                )
+            for card in cards:
+                if isinstance(card, Exception) and not is_client_error(card):
+                    raise card
+            for event, card in zip(missing, cards):
+                # Deleted or inaccessible cards won't come back, so their events
+                # are sent with the fields of the action payload
+                if isinstance(card, Exception):
+                    print(f"WARNING: Card {event.card_id} couldn't be loaded: {card}")
+                    continue
+                event.update(card)
+                self.card_cache.put(event.card_id, card)
         return result
 
 
 class SlackApi:
-    def __init__(self):
-        self.client = WebClient(token=settings.SLACK_API_KEY)
+    def __init__(self, pool_size=10):
+        self.timeout = getattr(settings, "SLACK_TIMEOUT_SECONDS", 30)
+        self.client = WebClient(token=settings.SLACK_API_KEY, timeout=self.timeout)
+        # WebClient opens a new connection per call, so messages are posted
+        # through a keep-alive pool instead
+        self.pool = HttpPool("slack", "https://slack.com/", pool_size)
+        self.retry_policy = get_retry_policy("slack")
 
     def print_users(self):
         """Prints all known Slack users which aren't bots and have a real name"""
@@ -88,12 +1504,28 @@ class SlackApi:
             if not user["is_bot"] and "real_name" in user:
                 print(f"{user['real_name']}: {user['id']}")
 
-    def send_message(self, card, slack_message):
-        """Notifies a user or channel about a new card via Slack message"""
+    def post_message(self, channel, text):
+        response = self.pool.request(
+            "POST",
+            "https://slack.com/api/chat.postMessage",
+            json={"channel": channel, "text": text},
+            headers={"Authorization": f"Bearer {settings.SLACK_API_KEY}"},
+            timeout=self.timeout,
+        )
+        body = response.json() if response.status_code == 200 else {}
+        if not body.get("ok"):
+            raise SlackError(response, body.get("error"))
+        return body
+
+    def send_message(self, card, slack_message, delivered=None):
+        """Notifies a user or channel about a new card via Slack message, skipping
+        the recipients in the delivered set and adding the ones done to it"""
+        if delivered is None:
+            delivered = set()
         if slack_message["recipient"] == "CARD_ASSIGNMENT":
-            recipients = [
-                f"@{get_user_mapping(trello_id=x)['slack_id']}" for x in card.member_id
-            ]
+            mappings = [get_user_mapping(trello_id=x) for x in card.member_ids]
+            # Members without a user mapping were warned about and are skipped
+            recipients = [f"@{x['slack_id']}" for x in mappings if x is not None]
         else:
             prefix = "@" if slack_message["type"] == "direct" else "#"
             recipients = [
@@ -101,17 +1533,38 @@ class SlackApi:
             ]
         if len(recipients) > 0:
             message_text = slack_message["message"]
-            message_text = message_text.replace("%board_name%", card.board.name)
+            message_text = message_text.replace("%board_name%", card.board_name)
             message_text = message_text.replace("%card_title%", card.name)
-            message_text = message_text.replace("%card_url%", card.shortUrl)
+            message_text = message_text.replace("%card_url%", card.short_url)
             message_text = message_text.replace("%card_action%", card.card_action)
             for recipient in recipients:
+                if recipient in delivered:
+                    continue
                 mapping = get_user_mapping(slack_id=recipient[1:])
+                msg = message_text
                 if mapping is not None:
                     msg = message_text.replace(
                         "%recipient_name%", mapping["display_name"]
                     )
-                self.client.chat_postMessage(channel=recipient, text=msg)
+                try:
+                    self.retry_policy.call(
+                        slack_retry_after, self.post_message, recipient, msg
+                    )
+                except SlackError as e:
+                    if e.error not in SLACK_RECIPIENT_ERRORS:
+                        raise
+                    print(f"WARNING: {e}, skipping message to {recipient}")
+                    delivered.add(recipient)
+                    continue
+                except requests.RequestException as e:
+                    if slack_retry_after(None, e) is not None:
+                        raise
+                    # The message may have been posted before the connection
+                    # failed, so it isn't sent a second time
+                    print(f"WARNING: {e}, message to {recipient} may be lost")
+                    delivered.add(recipient)
+                    continue
+                delivered.add(recipient)
                 print(
                     "Sent a message to "
                     f"{mapping['display_name'] if mapping else recipient} "
@@ -120,80 +1573,268 @@ class SlackApi:
 
 
 class Hook:
-    def __init__(self, hook):
-        self.last_check = datetime.utcnow().replace(microsecond=0).isoformat()
+    def __init__(self, hook, cursor_store=None):
         self.trello_boards = hook["trello_boards"]
+        self.board_ids = []
+        if self.trello_boards != "ALL_STARRED":
+            self.board_ids = [x.strip() for x in self.trello_boards.split(",")]
         self.list_name = hook["list_name"]
         self.triggers = [x.strip() for x in hook["triggers"].split(",")]
         self.slack_message = hook["slack_message"]
-        self.executor = ThreadPoolExecutor()
-
-    def execute(self, trello_api, slack_api, starred_boards):
-        try:
-            if self.trello_boards == "ALL_STARRED":
-                boards = starred_boards
-            else:
-                boards = [
-                    Board(client=trello_api.client, board_id=x.strip())
-                    for x in self.trello_boards.split(",")
-                ]
-            futures = []
-            for board in boards:
-                futures.append(
-                    self.executor.submit(
-                        trello_api.fetch_cards,
-                        self.triggers,
-                        board,
+        self.required_fields = get_required_fields(self.slack_message)
+        # Identifies the hook in the cursor store, the message text may change
+        # without losing the cursors
+        self.key = (
+            hook.get("id")
+            or hashlib.sha1(
+                json.dumps(
+                    [
+                        self.trello_boards,
                         self.list_name,
-                        f"{self.last_check}Z",
-                    )
-                )
-            for future in as_completed(futures):
-                cards = future.result()
-                for card in cards:
-                    slack_api.send_message(card, self.slack_message)
-            self.last_check = datetime.utcnow().replace(microsecond=0).isoformat()
-        except Exception:
-            traceback.print_exc()
+                        self.triggers,
+                        self.slack_message["type"],
+                        self.slack_message["recipient"],
+                    ]
+                ).encode()
+            ).hexdigest()
+        )
+        self.cursor_store = cursor_store
+        self.cursors = {}
+        # Recipients already notified about actions whose delivery was cut short
+        self.delivered = {}
+        if cursor_store is not None:
+            self.cursors = cursor_store.load(
+                self.key,
+                timedelta(seconds=getattr(settings, "CATCH_UP_SECONDS", 3600)),
+            )
+
+    def get_boards(self, trello_api, starred_boards):
+        """Returns the boards watched by this hook"""
+        if self.trello_boards == "ALL_STARRED":
+            return starred_boards
+        return [trello_api.boards.get(x) for x in self.board_ids]
+
+    def get_cursor(self, board_id):
+        """Returns the cursor of a board, starting at the current time for boards
+        this hook hasn't seen before, which is stored right away so actions
+        during a downtime aren't skipped"""
+        cursor = self.cursors.get(board_id)
+        if cursor is None:
+            cursor = self.cursors.setdefault(board_id, Cursor())
+            if self.cursor_store is not None:
+                self.cursor_store.stage(self.key, board_id, cursor)
+        return cursor
+
+    def forget(self, board_id):
+        """Drops the cursor of a board which is no longer watched"""
+        if self.cursors.pop(board_id, None) and self.cursor_store is not None:
+            self.cursor_store.stage(self.key, board_id, None)
+
+    def execute(self, pool, trello_api, slack_api, boards, board_futures):
+        """Queues sending the messages of every board as soon as its shared
+        actions of this cycle arrive and returns a future per board id, a failing
+        board is retried next cycle without affecting the others"""
+        return {
+            board.id: pool.submit_after(
+                board_futures[board.id],
+                self.key,
+                self.execute_board,
+                trello_api,
+                slack_api,
+                board,
+            )
+            for board in boards
+            if board.id in board_futures
+        }
+
+    def execute_board(self, trello_api, slack_api, board, actions):
+        """Sends messages for the actions of a board, oldest first, and moves the
+        cursor up to the last delivered one, returns whether all were delivered"""
+        cursor = self.get_cursor(board.id)
+        cards = trello_api.fetch_cards(
+            self.triggers, board, self.list_name, cursor, actions, self.required_fields
+        )
+        # Actions are returned newest first
+        newest = next(iter(actions), None)
+        for card in reversed(cards):
+            delivered = self.delivered.setdefault(card.action["id"], set())
+            try:
+                slack_api.send_message(card, self.slack_message, delivered)
+            except Exception:
+                traceback.print_exc()
+                # Retry the remaining recipients and all newer actions next cycle
+                return False
+            self.delivered.pop(card.action["id"], None)
+            self.update_cursor(board.id, card.action)
+        if newest is not None:
+            self.update_cursor(board.id, newest)
+        return True
+
+    def update_cursor(self, board_id, action):
+        """Moves the cursor of a board forward to an action"""
+        if not self.get_cursor(board_id).is_before(action):
+            return
+        self.cursors[board_id] = Cursor.from_action(action)
+        if self.cursor_store is not None:
+            self.cursor_store.stage(self.key, board_id, self.cursors[board_id])
 
 
 def main():
     parser = argparse.ArgumentParser(description="Trello/Slack Hooks")
     parser.add_argument("-l", "--list-users", action="store_true")
     args = parser.parse_args()
-    # Instantiate APIs
-    trello_api = TrelloApi()
-    slack_api = SlackApi()
+    # Instantiate APIs with a connection per worker
+    workers = getattr(settings, "WORKER_THREADS", 10)
+    trello_api = TrelloApi(pool_size=workers)
+    slack_api = SlackApi(pool_size=workers)
     # List users
     if args.list_users:
         trello_api.print_users()
         slack_api.print_users()
         os._exit(0)
+    # Restore the cursors of the last run
+    cursor_store = None
+    if getattr(settings, "CURSOR_DATABASE", None):
+        cursor_store = CursorStore(settings.CURSOR_DATABASE)
     # Instantiate Hooks and start main loop
-    hooks = [Hook(x) for x in settings.HOOKS]
-    any_starred = any(x.trello_boards == "ALL_STARRED" for x in hooks)
-    executor = ThreadPoolExecutor()
+    hooks = [Hook(x, cursor_store) for x in settings.HOOKS]
+    starred_hooks = [x for x in hooks if x.trello_boards == "ALL_STARRED"]
+    starred = StarredBoards(
+        trello_api, getattr(settings, "STARRED_REFRESH_SECONDS", 300)
+    )
+    trello_api.transport.pool.warm()
+    slack_api.pool.warm()
+    pool = WorkPool(workers)
+    scheduler = PollScheduler()
+    board_health = BoardHealth()
+    clock = CycleClock(
+        min(scheduler.min_interval, scheduler.base_interval),
+        getattr(settings, "CYCLE_JITTER_SECONDS", 0),
+    )
+    board_deadline = getattr(settings, "BOARD_DEADLINE_SECONDS", 60)
+    # Boards whose fetch or messages are still running, with their fetch future,
+    # the delivery future of every hook watching them, the tick they were polled
+    # at and their probed last activity
+    boards_in_flight = {}
+    # Last activity of every board up to which all of its hooks are done, most
+    # activity doesn't produce actions the cursors could move to
+    checked_activity = {}
+    metrics_interval = getattr(settings, "METRICS_LOG_SECONDS", 0)
+    next_metrics_log = time.monotonic() + metrics_interval
+    now = clock.tick
     while True:
         try:
-            # Fetch starred boards inside the loop as they might have changed,
-            # but only fetch them once
+            if metrics_interval and now >= next_metrics_log:
+                METRICS.log()
+                next_metrics_log = now + metrics_interval
+            # Record the boards which have finished since the last cycle without
+            # waiting for the others
+            late = 0
+            for board_id, (future, deliveries, polled, last_activity) in list(
+                boards_in_flight.items()
+            ):
+                if not future.done() or not all(x.done() for x in deliveries):
+                    if now > polled + board_deadline:
+                        late += 1
+                    continue
+                del boards_in_flight[board_id]
+                for delivery in deliveries:
+                    error = delivery.exception()
+                    if error is not None and error is not future.exception():
+                        traceback.print_exception(
+                            type(error), error, error.__traceback__
+                        )
+                error = future.exception()
+                if isinstance(error, BoardArchived):
+                    print(f"WARNING: {error}")
+                    board_health.mark_unavailable(board_id, now)
+                    scheduler.record(board_id, None, polled)
+                elif error is not None:
+                    traceback.print_exception(type(error), error, error.__traceback__)
+                    # Running out of time isn't the board's fault
+                    if not isinstance(error, FetchDeadlineExceeded):
+                        board_health.record_failure(board_id, error, now)
+                    scheduler.record(board_id, None, polled)
+                else:
+                    board_health.record_success(board_id)
+                    scheduler.record(board_id, future.result().count(), polled)
+                    if last_activity is not None and all(
+                        x.exception() is None and x.result() for x in deliveries
+                    ):
+                        checked_activity[board_id] = last_activity
+            METRICS.set("boards_late", late)
+            board_health.prune(now)
+            # Reload starred boards from time to time as they might have changed
+            # and stop tracking unstarred boards
             starred_boards = None
-            if any_starred:
-                starred_boards = trello_api.get_starred_boards()
+            if starred_hooks:
+                starred_boards, unstarred = starred.get(now)
+                for board_id in unstarred:
+                    scheduler.forget(board_id)
+                    board_health.forget(board_id)
+                    checked_activity.pop(board_id, None)
+                    for hook in starred_hooks:
+                        hook.forget(board_id)
+            # Fetch the actions of every watched board only once per cycle and
+            # share them between all hooks watching that board, skipping boards
+            # which aren't due yet or are still running late from a previous cycle
+            hook_boards = {
+                hook: [
+                    x
+                    for x in hook.get_boards(trello_api, starred_boards)
+                    if scheduler.is_due(x.id, now)
+                    and board_health.allows(x.id, now)
+                    and x.id not in boards_in_flight
+                ]
+                for hook in hooks
+            }
+            plan = plan_fetches(hook_boards, now + board_deadline)
+            probe = getattr(settings, "TRELLO_PROBE_ACTIVITY", False)
+            org_feed_min_boards = getattr(settings, "TRELLO_ORG_FEED_MIN_BOARDS", 0)
+            idle_boards = []
+            feeds = {}
+            if plan and (probe or org_feed_min_boards):
+                member_boards = trello_api.get_member_boards()
+                if probe:
+                    plan, idle_boards = probe_boards(
+                        member_boards, plan, checked_activity
+                    )
+                if org_feed_min_boards:
+                    feeds = plan_organization_feeds(
+                        member_boards, plan, org_feed_min_boards
+                    )
+            board_futures = submit_fetches(pool, trello_api, plan, feeds)
             # Hook execution
-            futures = []
+            entries = dict(plan)
+            for org_entries in feeds.values():
+                entries.update(org_entries)
+            for board_id, future in board_futures.items():
+                boards_in_flight[board_id] = (
+                    future,
+                    [],
+                    now,
+                    entries[board_id].get("last_activity"),
+                )
             for hook in hooks:
-                futures.append(
-                    executor.submit(hook.execute, trello_api, slack_api, starred_boards)
+                deliveries = hook.execute(
+                    pool, trello_api, slack_api, hook_boards[hook], board_futures
                 )
-            for future in futures:
-                future.result()
+                for board_id, delivery in deliveries.items():
+                    boards_in_flight[board_id][1].append(delivery)
+            for board_id in idle_boards:
+                scheduler.record(board_id, 0, now)
+            if cursor_store is not None:
+                cursor_store.commit()
         except KeyboardInterrupt:
+            if cursor_store is not None:
+                cursor_store.commit()
             os._exit(0)
         except Exception:
             traceback.print_exc()
         finally:
-            time.sleep(settings.CHECK_INTERVAL_SECONDS)
+            # Boards are scheduled from the tick a cycle was due at, not the
+            # time it actually started or finished
+            now = clock.wait(now + scheduler.sleep_time(now))
 
 
 if __name__ == "__main__":